@@ -1,22 +1,37 @@
 """
 E-Cart Telegram Bot - Virtual Card Management System
-Simplified version - displays transactions directly in chat
+Simplified version - short statements are shown in chat, longer ones
+are sent as a single .txt document
 All user-facing messages in Arabic (العربية)
 """
 
 import os
 import re
+import math
+import functools
+import hmac
 import logging
 import threading
 import time
+import secrets
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain
 from typing import Optional, Dict, List, Tuple
+from urllib.parse import urlsplit
 
 import telebot
 from telebot import types
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+import orjson
+import redis
 import requests
-from flask import Flask
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
 
 # ============================================================================
 # CONFIGURATION
@@ -25,6 +40,13 @@ from flask import Flask
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 API_KEY = os.environ.get("API_KEY")
 PORT = int(os.environ.get("PORT", 8080))
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 8))
+# Optional - sessions go to Redis (shared, survive restarts) when set
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL = 3600
+# Public HTTPS base URL - opt-in; when set, Telegram pushes updates via
+# webhook instead of the bot polling
+PUBLIC_URL = (os.environ.get("PUBLIC_URL") or "").rstrip("/")
 
 BASE_URL = "https://private.mybrocard.com/api/v2"
 
@@ -42,24 +64,155 @@ if not API_KEY:
     logger.error("API_KEY environment variable is required")
     sys.exit(1)
 
-# Initialize bot (threaded=False to avoid conflicts)
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
-
-# User sessions
-user_sessions: Dict[int, Dict] = {}
-
-# Flask keep-alive
-app = Flask(__name__)
-
-
-@app.route("/")
-def health_check():
-    return "E-Cart Bot is running!", 200
 
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
 
-@app.route("/health")
-def health():
-    return {"status": "healthy", "service": "E-Cart"}, 200
+class RateLimiter:
+    """Token bucket - free while under budget, blocks only as long as needed above it"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledTeleBot(telebot.TeleBot):
+    """TeleBot whose sends respect Telegram flood limits and retry once on 429"""
+    
+    # Longest retry_after a worker thread may sleep through; above it the 429 is raised
+    MAX_FLOOD_WAIT = 5
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.global_limiter = RateLimiter(rate=30, capacity=30)
+        # Re-inserted on every use, so only chats idle for 60s are evicted
+        # (by then their bucket would be full again anyway)
+        self.chat_limiters = TTLCache(maxsize=10_000, ttl=60)
+        self.chat_limiters_lock = threading.Lock()
+    
+    def _chat_limiter(self, chat_id) -> RateLimiter:
+        with self.chat_limiters_lock:
+            limiter = self.chat_limiters.get(chat_id) or RateLimiter(rate=1, capacity=3)
+            self.chat_limiters[chat_id] = limiter
+            return limiter
+    
+    def _throttled(self, chat_id, call, *args, **kwargs):
+        for attempt in range(2):
+            self._chat_limiter(chat_id).acquire()
+            self.global_limiter.acquire()
+            try:
+                return call(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt:
+                    raise
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                if retry_after > self.MAX_FLOOD_WAIT:
+                    raise
+                logger.warning("Telegram flood limit, retrying in %ss", retry_after)
+                time.sleep(retry_after)
+    
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._throttled(chat_id, super().send_message, chat_id, text, *args, **kwargs)
+    
+    def send_document(self, chat_id, document, *args, **kwargs):
+        return self._throttled(chat_id, super().send_document, chat_id, document, *args, **kwargs)
+    
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._throttled(chat_id, super().edit_message_text, text, chat_id, *args, **kwargs)
+
+
+# Session lookup runs once per update in a middleware (see attach_session)
+apihelper.ENABLE_MIDDLEWARE = True
+
+# Initialize bot - updates are dispatched to a worker pool so one slow
+# statement does not block every other user
+bot = ThrottledTeleBot(BOT_TOKEN, parse_mode="HTML", threaded=True, num_threads=BOT_WORKERS)
+
+# User sessions - Redis when configured, else a bounded in-process cache;
+# idle sessions expire after SESSION_TTL either way. Lookups run on the
+# update dispatch thread, so a hung Redis must fail fast (= logged out)
+redis_client = redis.Redis.from_url(
+    REDIS_URL, decode_responses=True, socket_timeout=2, socket_connect_timeout=2
+) if REDIS_URL else None
+user_sessions: TTLCache = TTLCache(maxsize=10_000, ttl=SESSION_TTL)
+sessions_lock = threading.RLock()
+
+
+WEBHOOK_PATH = f"/{BOT_TOKEN}"
+# Sent back by Telegram on every webhook POST - new per process, it is
+# registered again by set_webhook on each start
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+# Only messages are handled - don't receive any other update types
+ALLOWED_UPDATES = ["message"]
+
+
+# Keep-alive + webhook HTTP server (stdlib - a few routes do not need Flask)
+class HealthHandler(BaseHTTPRequestHandler):
+    ROUTES = {
+        "/": ("E-Cart Bot is running!".encode("utf-8"), "text/plain; charset=utf-8"),
+        "/health": (b'{"status": "healthy", "service": "E-Cart"}', "application/json"),
+    }
+    
+    def do_GET(self):
+        self._serve_route(send_body=True)
+    
+    def do_HEAD(self):
+        # Uptime pingers often use HEAD - same headers as GET, no body
+        self._serve_route(send_body=False)
+    
+    def _serve_route(self, send_body: bool):
+        route = self.ROUTES.get(urlsplit(self.path).path)
+        if route:
+            self._respond(200, *route, send_body=send_body)
+        else:
+            self._respond(404, b"Not Found", "text/plain", send_body=send_body)
+    
+    def do_POST(self):
+        if urlsplit(self.path).path != WEBHOOK_PATH:
+            self._respond(404, b"Not Found", "text/plain")
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+            self._respond(403, b"Forbidden", "text/plain")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except Exception as e:
+            logger.warning("Bad webhook body: %s", e)
+            self._respond(400, b"Bad Request", "text/plain")
+            return
+        # Always acknowledge a parsed update so Telegram does not redeliver it
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error("Webhook dispatch error: %s", e)
+        self._respond(200, b"", "text/plain")
+    
+    def _respond(self, status: int, body: bytes, content_type: str, send_body: bool = True):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
 
 
 # ============================================================================
@@ -84,7 +237,7 @@ def clear_webhook_and_updates():
         logger.info("Webhook cleared successfully")
         return True
     except Exception as e:
-        logger.error(f"Error clearing webhook: {e}")
+        logger.error("Error clearing webhook: %s", e)
         return False
 
 
@@ -147,6 +300,8 @@ class Messages:
     
     NO_TRANSACTIONS = "📭 لا توجد معاملات."
     
+    STATEMENT_LOADING = "⏳ كشف الحساب قيد التحميل بالفعل، انتظر قليلاً."
+    
     LOGGED_OUT = "👋 تم تسجيل الخروج. أرسل بيانات البطاقة للدخول مجدداً."
     
     SESSION_EXPIRED = "⚠️ انتهت الجلسة. أرسل بيانات البطاقة."
@@ -168,57 +323,114 @@ class ECartAPI:
             "Content-Type": "application/json",
             "Accept": "application/json"
         })
-        self.timeout = 30
-    
-    def _request(self, method: str, endpoint: str, params: dict = None) -> Optional[Dict]:
+        # Keep-alive pool sized for parallel pages across concurrent users;
+        # transient 429/5xx are retried (honouring Retry-After)
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=64,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = (3.05, 30)  # (connect, read) - fail fast on dead connects
+        # Shared budget for all handlers (replaces fixed sleeps between pages)
+        self.limiter = RateLimiter(rate=10, capacity=10)
+        # Cards and embed checks rarely change; payments are never cached
+        # because 3DS codes must always be fresh
+        self._cache_lock = threading.Lock()
+        self._cards_cache = TTLCache(maxsize=1024, ttl=90)
+        self._embed_cache = TTLCache(maxsize=512, ttl=120)
+        # Last (ETag, body) per small GET (/cards, 3DS page) - revalidated
+        # with If-None-Match; full statement pages are too big to keep here
+        self._etag_cache = TTLCache(maxsize=256, ttl=3600)
+    
+    def _request(self, method: str, endpoint: str, params: dict = None, conditional: bool = False) -> Optional[Dict]:
         url = f"{self.base_url}{endpoint}"
+        key = (endpoint, tuple(sorted(params.items())) if params else ())
+        headers = {}
+        cached = None
+        if conditional:
+            with self._cache_lock:
+                cached = self._etag_cache.get(key)
+            if cached:
+                headers["If-None-Match"] = cached[0]
+        self.limiter.acquire()
         try:
-            response = self.session.request(method=method, url=url, params=params, timeout=self.timeout)
+            response = self.session.request(method=method, url=url, params=params, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached:
+                return cached[1]
             if response.status_code >= 400:
-                logger.error(f"API error {response.status_code}")
+                logger.error("API error %s", response.status_code)
                 return None
-            return response.json()
+            data = orjson.loads(response.content)
+            etag = response.headers.get("ETag")
+            if conditional and etag:
+                with self._cache_lock:
+                    self._etag_cache[key] = (etag, data)
+            return data
         except Exception as e:
-            logger.error(f"API error: {e}")
+            logger.error("API error: %s", e)
             return None
     
+    def _cached(self, cache: TTLCache, key, fetch) -> Optional[Dict]:
+        with self._cache_lock:
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+        result = fetch()
+        if result is not None:
+            with self._cache_lock:
+                cache[key] = result
+        return result
+    
     def get_cards(self, last_fours: List[str] = None) -> Optional[Dict]:
         params = {"page": 1, "per_page": 100, "archived": "include"}
         if last_fours:
             for i, lf in enumerate(last_fours):
                 params[f"last_fours[{i}]"] = lf
-        return self._request("GET", "/cards", params=params)
+        key = tuple(sorted(params.items()))
+        return self._cached(self._cards_cache, key, lambda: self._request("GET", "/cards", params=params, conditional=True))
     
     def create_embed_link(self, card_id: int) -> Optional[Dict]:
-        return self._request("POST", f"/cards/{card_id}/embed")
+        return self._cached(self._embed_cache, card_id, lambda: self._request("POST", f"/cards/{card_id}/embed"))
     
-    def get_payments(self, card_id: int, page: int = 1, per_page: int = 100) -> Optional[Dict]:
+    def get_payments(self, card_id: int, page: int = 1, per_page: int = 100, conditional: bool = False) -> Optional[Dict]:
         params = {"page": page, "per_page": per_page, "cards[]": card_id}
-        return self._request("GET", "/payments", params=params)
+        return self._request("GET", "/payments", params=params, conditional=conditional)
     
     def get_all_payments(self, card_id: int, callback=None) -> Tuple[List[Dict], bool]:
-        """Fetch ALL payments with pagination"""
-        all_payments = []
-        page = 1
-        total_pages = 1
+        """Fetch ALL payments - page 1 first, then remaining pages in parallel"""
+        result = self.get_payments(card_id=card_id, page=1, per_page=1000)
+        if not result:
+            return [], False
         
-        while page <= total_pages:
-            if callback and page > 1:
-                callback(page, total_pages)
-            
-            result = self.get_payments(card_id=card_id, page=page, per_page=1000)
-            if not result:
-                return all_payments, False
-            
-            payments = result.get("data", [])
-            all_payments.extend(payments)
-            total_pages = result.get("last_page", 1)
-            page += 1
-            
-            if page <= total_pages:
-                time.sleep(0.2)
+        first_page = result.get("data", [])
+        total_pages = result.get("last_page", 1)
+        if total_pages <= 1:
+            return list(first_page), True
         
-        return all_payments, True
+        def fetch(p: int) -> Optional[Dict]:
+            return self.get_payments(card_id=card_id, page=p, per_page=1000)
+        
+        # Pages complete out of order; progress reports completed count
+        results = {1: first_page}
+        success = True
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(fetch, p): p for p in range(2, total_pages + 1)}
+            for done, future in enumerate(as_completed(futures), start=2):
+                result = future.result()
+                if not result:
+                    success = False
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                results[futures[future]] = result.get("data", [])
+                if callback:
+                    callback(done, total_pages)
+        
+        # Merge pages in page order in one pass
+        all_payments = list(chain.from_iterable(results[page] for page in sorted(results)))
+        return all_payments, success
 
 
 api_client = ECartAPI(API_KEY, BASE_URL)
@@ -228,112 +440,228 @@ api_client = ECartAPI(API_KEY, BASE_URL)
 # HELPERS
 # ============================================================================
 
+CARD_PATTERN = re.compile(r'(\d{4}[\s\-]?\d{4}[\s\-]?\d{4}[\s\-]?\d{4})\s+(\d{3,4})\s+(\d{2})[\/\-]?(\d{2})')
+CARD_SEPARATORS = re.compile(r'[\s\-]')
+
+
 def parse_card_input(text: str) -> Optional[Dict]:
-    text = text.strip()
-    patterns = [
-        r'^(\d{4}[\s\-]?\d{4}[\s\-]?\d{4}[\s\-]?\d{4})\s+(\d{3,4})\s+(\d{2})[\/\-](\d{2})$',
-        r'^(\d{4}[\s\-]?\d{4}[\s\-]?\d{4}[\s\-]?\d{4})\s+(\d{3,4})\s+(\d{2})(\d{2})$',
-    ]
-    
-    for pattern in patterns:
-        match = re.match(pattern, text)
-        if match:
-            card_number = re.sub(r'[\s\-]', '', match.group(1))
-            if len(card_number) != 16:
-                return None
-            month = match.group(3)
-            if not (1 <= int(month) <= 12):
-                return None
-            return {
-                "card_number": card_number,
-                "last_four": card_number[-4:],
-                "cvv": match.group(2),
-                "expiry": f"{month}/{match.group(4)}"
-            }
-    return None
+    match = CARD_PATTERN.fullmatch(text.strip())
+    if not match:
+        return None
+    card_number = CARD_SEPARATORS.sub('', match.group(1))
+    if len(card_number) != 16:
+        return None
+    month = match.group(3)
+    if not (1 <= int(month) <= 12):
+        return None
+    return {
+        "card_number": card_number,
+        "last_four": card_number[-4:],
+        "cvv": match.group(2),
+        "expiry": f"{month}/{match.group(4)}"
+    }
 
 
-def find_card(last_four: str) -> Optional[Dict]:
+def find_cards(last_four: str) -> List[Dict]:
     result = api_client.get_cards(last_fours=[last_four])
     if not result or not result.get("data"):
-        return None
-    for card in result["data"]:
-        if card.get("last_four") == last_four:
+        return []
+    return [card for card in result["data"] if card.get("last_four") == last_four]
+
+
+def verify_card(candidates: List[Dict]) -> Optional[Dict]:
+    """Return the first candidate, in listing order, whose embed check passes"""
+    for card in candidates:
+        if api_client.create_embed_link(card["id"]):
             return card
     return None
 
 
+# Cards with a statement fetch in flight - duplicate taps are told it is
+# already loading instead of waiting on a worker; complete statements are
+# reused for a minute
+inflight_statements: set = set()
+statement_cache: TTLCache = TTLCache(maxsize=500, ttl=60)
+inflight_lock = threading.Lock()
+
+
+def fetch_statement_payments(card_id: int, callback=None) -> Optional[Tuple[List[Dict], bool]]:
+    """Cached, single-flight wrapper around get_all_payments - None while another fetch runs"""
+    with inflight_lock:
+        cached = statement_cache.get(card_id)
+        if cached is not None:
+            return cached, True
+        if card_id in inflight_statements:
+            return None
+        inflight_statements.add(card_id)
+    
+    try:
+        payments, success = api_client.get_all_payments(card_id, callback=callback)
+        if success:
+            with inflight_lock:
+                statement_cache[card_id] = payments
+        return payments, success
+    finally:
+        with inflight_lock:
+            inflight_statements.discard(card_id)
+
+
+def invalidate_statement(card_id: int):
+    with inflight_lock:
+        statement_cache.pop(card_id, None)
+
+
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[ T](\d{2}:\d{2})')
+
+
+@functools.lru_cache(maxsize=4096)
 def format_date(date_str: str) -> str:
     if not date_str:
         return "N/A"
-    try:
-        dt = datetime.strptime(date_str[:19], "%Y-%m-%d %H:%M:%S")
-        return dt.strftime("%Y/%m/%d - %H:%M")
-    except:
+    match = DATE_PATTERN.match(date_str)
+    if not match:
         return date_str[:16]
+    year, month, day, hh_mm = match.groups()
+    return f"{year}/{month}/{day} - {hh_mm}"
 
 
 def get_raw_descriptor(payment: Dict) -> str:
     """Get RAW DESCRIPTOR - contains 3DS codes"""
-    merchant = payment.get("merchant", {})
+    merchant = payment.get("merchant") or {}
     return merchant.get("descriptor") or merchant.get("name") or "N/A"
 
 
+TELEGRAM_TEXT_LIMIT = 4000  # Telegram allows 4096 UTF-16 code units
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def payment_date_key(payment: Dict) -> str:
+    return payment.get("date") or ""
+
+
+def unique_payments(payments: List[Dict]) -> List[Dict]:
+    """Drop rows repeated across pages (new payments shift page boundaries)"""
+    seen = set()
+    unique = []
+    for p in payments:
+        pid = p.get("id")
+        if pid is not None:
+            if pid in seen:
+                continue
+            seen.add(pid)
+        unique.append(p)
+    return unique
+
+
+SETTLED_STATES = frozenset({1})
+
+
+def calculate_total_spend(payments: List[Dict]) -> float:
+    """Sum of settled amounts - fsum avoids drift over thousands of rows"""
+    return math.fsum(
+        float(p.get("amount", 0)) for p in payments
+        if p.get("state", {}).get("value") in SETTLED_STATES
+    )
+
+
+STATE_ICONS = {0: "🟡", 1: "✅", 2: "🔄", 3: "❌", 4: "↩️"}
+STATE_NAMES = {0: "معلق", 1: "مكتمل", 2: "ملغي", 3: "مرفوض", 4: "مسترد"}
+STATEMENT_ROW = "%s <code>%s</code>\n   💰 $%s %s | 📅 %s\n"
+
+
 def get_status_icon(state: int) -> str:
-    return {0: "🟡", 1: "✅", 2: "🔄", 3: "❌", 4: "↩️"}.get(state, "❓")
+    return STATE_ICONS.get(state, "❓")
 
 
 # ============================================================================
 # KEYBOARDS
 # ============================================================================
 
-def main_menu_kb():
+def build_main_menu_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     kb.add(types.KeyboardButton(Messages.BTN_3DS), types.KeyboardButton(Messages.BTN_STATEMENT))
     kb.add(types.KeyboardButton(Messages.BTN_LOGOUT))
     return kb
 
 
-def back_kb():
+def build_back_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     kb.add(types.KeyboardButton(Messages.BTN_REFRESH), types.KeyboardButton(Messages.BTN_BACK))
     return kb
 
 
-def remove_kb():
-    return types.ReplyKeyboardRemove()
+# Markups never change - build and serialize once; telebot sends
+# pre-serialized JSON strings as is
+MAIN_MENU_KB = build_main_menu_kb().to_json()
+BACK_KB = build_back_kb().to_json()
+REMOVE_KB = types.ReplyKeyboardRemove().to_json()
 
 
 # ============================================================================
 # SESSION
 # ============================================================================
 
+def session_key(user_id: int) -> str:
+    return f"sess:{user_id}"
+
+
 def get_session(user_id: int) -> Optional[Dict]:
-    return user_sessions.get(user_id)
+    """Return the session and push its expiry back - sessions expire when idle"""
+    if redis_client:
+        raw = redis_client.getex(session_key(user_id), ex=SESSION_TTL)
+        return orjson.loads(raw) if raw else None
+    with sessions_lock:
+        session = user_sessions.get(user_id)
+        if session is not None:
+            # Re-assigning restarts the TTLCache timer
+            user_sessions[user_id] = session
+        return session
 
 
 def create_session(user_id: int, card: Dict):
-    user_sessions[user_id] = {"card_id": card.get("id"), "card": card}
+    session = {"card_id": card.get("id"), "card": card}
+    if redis_client:
+        redis_client.set(session_key(user_id), orjson.dumps(session), ex=SESSION_TTL)
+        return
+    with sessions_lock:
+        user_sessions[user_id] = session
 
 
 def destroy_session(user_id: int):
-    user_sessions.pop(user_id, None)
-
-
-def is_logged_in(user_id: int) -> bool:
-    return user_id in user_sessions
+    if redis_client:
+        try:
+            redis_client.delete(session_key(user_id))
+        except redis.RedisError as e:
+            # The key still expires after SESSION_TTL idle - finish the logout
+            logger.error("Session delete error: %s", e)
+    else:
+        with sessions_lock:
+            user_sessions.pop(user_id, None)
 
 
 # ============================================================================
 # HANDLERS
 # ============================================================================
 
+@bot.middleware_handler(update_types=["message"])
+def attach_session(bot_instance, msg):
+    """Look the session up once per message; handlers read msg.session"""
+    try:
+        msg.session = get_session(msg.from_user.id)
+    except Exception as e:
+        logger.error("Session lookup error: %s", e)
+        msg.session = None
+
+
 @bot.message_handler(commands=["start"])
 def cmd_start(msg):
-    if is_logged_in(msg.from_user.id):
-        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=main_menu_kb())
+    if msg.session:
+        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=MAIN_MENU_KB)
     else:
-        bot.send_message(msg.chat.id, Messages.WELCOME, reply_markup=remove_kb())
+        bot.send_message(msg.chat.id, Messages.WELCOME, reply_markup=REMOVE_KB)
 
 
 @bot.message_handler(commands=["help"])
@@ -341,38 +669,39 @@ def cmd_help(msg):
     bot.reply_to(msg, Messages.HELP)
 
 
-@bot.message_handler(func=lambda m: m.text == Messages.BTN_LOGOUT)
 def btn_logout(msg):
+    if msg.session:
+        invalidate_statement(msg.session["card_id"])
     destroy_session(msg.from_user.id)
-    bot.send_message(msg.chat.id, Messages.LOGGED_OUT, reply_markup=remove_kb())
+    bot.send_message(msg.chat.id, Messages.LOGGED_OUT, reply_markup=REMOVE_KB)
 
 
-@bot.message_handler(func=lambda m: m.text == Messages.BTN_BACK)
 def btn_back(msg):
-    if not is_logged_in(msg.from_user.id):
-        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=remove_kb())
+    if not msg.session:
+        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=REMOVE_KB)
         return
-    bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=main_menu_kb())
+    bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=MAIN_MENU_KB)
 
 
-@bot.message_handler(func=lambda m: m.text in [Messages.BTN_3DS, Messages.BTN_REFRESH])
 def btn_3ds(msg):
     """Show recent transactions with RAW DESCRIPTOR for 3DS codes - ALL STATES"""
     user_id = msg.from_user.id
     
-    if not is_logged_in(user_id):
-        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=remove_kb())
+    session = msg.session
+    if not session:
+        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=REMOVE_KB)
         return
     
-    session = get_session(user_id)
     card_id = session["card_id"]
     last_four = session["card"].get("last_four", "****")
     
-    loading = bot.send_message(msg.chat.id, Messages.FETCHING, reply_markup=back_kb())
+    loading = bot.send_message(msg.chat.id, Messages.FETCHING, reply_markup=BACK_KB)
     
     try:
         # Fetch more transactions to find 3DS codes (they might be AUTH or DECLINED)
-        result = api_client.get_payments(card_id, page=1, per_page=20)
+        # Always live - a code may have arrived seconds ago (ETag makes an
+        # unchanged page a cheap 304)
+        result = api_client.get_payments(card_id, page=1, per_page=20, conditional=True)
         
         if not result or not result.get("data"):
             bot.edit_message_text(Messages.NO_TRANSACTIONS, msg.chat.id, loading.message_id)
@@ -397,7 +726,7 @@ def btn_3ds(msg):
             date = format_date(p.get("date", ""))
             
             # Get state name in Arabic
-            state_name = {0: "معلق", 1: "مكتمل", 2: "ملغي", 3: "مرفوض", 4: "مسترد"}.get(state, "؟")
+            state_name = STATE_NAMES.get(state, "؟")
             
             lines.append(f"{icon} <code>{descriptor}</code>")
             lines.append(f"   💰 ${amount} {currency} | {state_name}")
@@ -410,46 +739,56 @@ def btn_3ds(msg):
         bot.edit_message_text("\n".join(lines), msg.chat.id, loading.message_id)
         
     except Exception as e:
-        logger.error(f"3DS error: {e}")
+        logger.error("3DS error: %s", e)
         bot.edit_message_text(Messages.ERROR, msg.chat.id, loading.message_id)
 
 
-@bot.message_handler(func=lambda m: m.text == Messages.BTN_STATEMENT)
 def btn_statement(msg):
     """Show all transactions with total spend - directly in chat - ALL STATES"""
     user_id = msg.from_user.id
     
-    if not is_logged_in(user_id):
-        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=remove_kb())
+    session = msg.session
+    if not session:
+        bot.send_message(msg.chat.id, Messages.SESSION_EXPIRED, reply_markup=REMOVE_KB)
         return
     
-    session = get_session(user_id)
     card_id = session["card_id"]
     last_four = session["card"].get("last_four", "****")
     
-    loading = bot.send_message(msg.chat.id, "📜 جاري جلب جميع المعاملات...", reply_markup=back_kb())
+    loading = bot.send_message(msg.chat.id, "📜 جاري جلب جميع المعاملات...", reply_markup=BACK_KB)
     
     try:
+        # Coalesce progress edits to one per 0.8s (Telegram edit flood limit);
+        # no edit for the last page - the loading message is deleted right after
+        last_edit = time.monotonic()
+        
         def update_progress(current, total):
+            nonlocal last_edit
+            now = time.monotonic()
+            if current >= total or now - last_edit < 0.8:
+                return
+            last_edit = now
             try:
                 bot.edit_message_text(f"📜 جاري جلب الصفحة {current}/{total}...", msg.chat.id, loading.message_id)
             except:
                 pass
         
-        all_payments, success = api_client.get_all_payments(card_id, callback=update_progress)
+        result = fetch_statement_payments(card_id, callback=update_progress)
+        if result is None:
+            bot.edit_message_text(Messages.STATEMENT_LOADING, msg.chat.id, loading.message_id)
+            return
+        all_payments, success = result
+        all_payments = unique_payments(all_payments)
         
         if not all_payments:
             bot.edit_message_text(Messages.NO_TRANSACTIONS, msg.chat.id, loading.message_id)
             return
         
         # Calculate total for SETTLED only, but show ALL transactions
-        total_spend = 0.0
-        for p in all_payments:
-            if p.get("state", {}).get("value") == 1:  # Only settled for total
-                total_spend += float(p.get("amount", 0))
+        total_spend = calculate_total_spend(all_payments)
         
         # Sort by date (newest first)
-        all_payments.sort(key=lambda x: x.get("date", ""), reverse=True)
+        all_payments.sort(key=payment_date_key, reverse=True)
         
         # Delete loading message
         try:
@@ -457,7 +796,7 @@ def btn_statement(msg):
         except:
             pass
         
-        # Send summary
+        # Summary
         summary = f"""📜 <b>كشف الحساب</b>
 
 💳 xxxx-xxxx-xxxx-{last_four}
@@ -469,35 +808,51 @@ def btn_statement(msg):
 ━━━━━━━━━━━━━━━━━━━━━━
 🟡=معلق ✅=مكتمل ❌=مرفوض 🔄=ملغي ↩️=مسترد"""
         
-        bot.send_message(msg.chat.id, summary, reply_markup=main_menu_kb())
+        # Render transactions - ALL STATES
+        rows = [
+            STATEMENT_ROW % (
+                STATE_ICONS.get(p.get("state", {}).get("value", -1), "❓"),
+                get_raw_descriptor(p),
+                p.get("amount", "0"),
+                p.get("currency", "USD"),
+                format_date(p.get("date", "")),
+            )
+            for p in all_payments
+        ]
         
-        # Send transactions in chunks (to avoid message too long) - ALL STATES
-        chunk_size = 15
-        for i in range(0, len(all_payments), chunk_size):
-            chunk = all_payments[i:i + chunk_size]
-            
-            lines = []
-            for p in chunk:
-                state = p.get("state", {}).get("value", -1)
-                icon = get_status_icon(state)
-                descriptor = get_raw_descriptor(p)
-                amount = p.get("amount", "0")
-                currency = p.get("currency", "USD")
-                date = format_date(p.get("date", ""))
-                
-                lines.append(f"{icon} <code>{descriptor}</code>")
-                lines.append(f"   💰 ${amount} {currency} | 📅 {date}")
-                lines.append("")
-            
-            if lines:
-                bot.send_message(msg.chat.id, "\n".join(lines))
-                time.sleep(0.3)  # Avoid flood
+        report = "\n".join(rows)
+        if utf16_len(report) <= TELEGRAM_TEXT_LIMIT:
+            bot.send_message(msg.chat.id, summary, reply_markup=MAIN_MENU_KB)
+            bot.send_message(msg.chat.id, report)
+        else:
+            # Longer than one message - single upload, no flood-limit sleeps
+            report = report.replace("<code>", "").replace("</code>", "")
+            bot.send_document(
+                msg.chat.id, report.encode("utf-8"),
+                caption=summary, reply_markup=MAIN_MENU_KB,
+                visible_file_name=f"statement_{last_four}_{datetime.now().strftime('%Y%m%d')}.txt"
+            )
         
-        logger.info(f"Statement for user {user_id}: ${total_spend:.2f}, {len(all_payments)} transactions")
+        logger.info("Statement for user %s: $%.2f, %d transactions", user_id, total_spend, len(all_payments))
         
     except Exception as e:
-        logger.error(f"Statement error: {e}")
-        bot.send_message(msg.chat.id, Messages.ERROR, reply_markup=main_menu_kb())
+        logger.error("Statement error: %s", e)
+        bot.send_message(msg.chat.id, Messages.ERROR, reply_markup=MAIN_MENU_KB)
+
+
+# Menu buttons - one hash lookup instead of a filter per button
+BUTTON_HANDLERS = {
+    Messages.BTN_3DS: btn_3ds,
+    Messages.BTN_REFRESH: btn_3ds,
+    Messages.BTN_STATEMENT: btn_statement,
+    Messages.BTN_LOGOUT: btn_logout,
+    Messages.BTN_BACK: btn_back,
+}
+
+
+@bot.message_handler(func=lambda m: m.text in BUTTON_HANDLERS)
+def handle_button(msg):
+    BUTTON_HANDLERS[msg.text](msg)
 
 
 @bot.message_handler(func=lambda m: True)
@@ -510,8 +865,8 @@ def handle_text(msg):
         return
     
     # If logged in, show menu
-    if is_logged_in(user_id):
-        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=main_menu_kb())
+    if msg.session:
+        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=MAIN_MENU_KB)
         return
     
     # Try parse as card
@@ -523,15 +878,15 @@ def handle_text(msg):
     loading = bot.reply_to(msg, Messages.SEARCHING)
     
     try:
-        card = find_card(card_input["last_four"])
+        candidates = find_cards(card_input["last_four"])
         
-        if not card:
+        if not candidates:
             bot.edit_message_text(Messages.CARD_NOT_FOUND, msg.chat.id, loading.message_id)
             return
         
         # Verify ownership
-        embed = api_client.create_embed_link(card["id"])
-        if not embed:
+        card = verify_card(candidates)
+        if not card:
             bot.edit_message_text(Messages.VERIFICATION_FAILED, msg.chat.id, loading.message_id)
             return
         
@@ -543,12 +898,12 @@ def handle_text(msg):
             msg.chat.id, loading.message_id
         )
         
-        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=main_menu_kb())
+        bot.send_message(msg.chat.id, Messages.MAIN_MENU, reply_markup=MAIN_MENU_KB)
         
-        logger.info(f"User {user_id} logged in with card {card['id']}")
+        logger.info("User %s logged in with card %s", user_id, card["id"])
         
     except Exception as e:
-        logger.error(f"Login error: {e}")
+        logger.error("Login error: %s", e)
         bot.edit_message_text(Messages.ERROR, msg.chat.id, loading.message_id)
 
 
@@ -556,8 +911,8 @@ def handle_text(msg):
 # MAIN
 # ============================================================================
 
-def run_flask():
-    app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
+def run_http_server():
+    ThreadingHTTPServer(("0.0.0.0", PORT), HealthHandler).serve_forever()
 
 
 def main():
@@ -565,25 +920,28 @@ def main():
     logger.info("Starting E-Cart Bot...")
     logger.info("=" * 50)
     
+    if PUBLIC_URL:
+        # Webhook mode - Telegram pushes updates to the HTTP server
+        bot.remove_webhook()
+        bot.set_webhook(
+            url=f"{PUBLIC_URL}{WEBHOOK_PATH}", allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET
+        )
+        logger.info("Webhook set, serving on port %s", PORT)
+        run_http_server()
+        return
+    
     # Fix 409 error
     clear_webhook_and_updates()
     
-    # Start Flask
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"Flask started on port {PORT}")
+    # Start keep-alive server
+    http_thread = threading.Thread(target=run_http_server, daemon=True)
+    http_thread.start()
+    logger.info("HTTP server started on port %s", PORT)
     
-    # Start polling
+    # Start polling (infinity_polling reconnects on errors by itself)
     logger.info("Starting bot polling...")
-    
-    while True:
-        try:
-            bot.infinity_polling(timeout=60, long_polling_timeout=30)
-        except Exception as e:
-            logger.error(f"Polling error: {e}")
-            time.sleep(10)
-            clear_webhook_and_updates()
-            logger.info("Restarting...")
+    bot.infinity_polling(timeout=90, long_polling_timeout=50, allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":